@@ -8,32 +8,289 @@ __license__ = 'MIT'
 __email__ = 'slamb@slamb.org'
 
 import argparse
+import ctypes
 import errno
-import select
+import logging
+import os
+import selectors
+import signal
 import socket
 import struct
 import sys
 import time
-from typing import Dict, Tuple
+from typing import Callable, Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
 
 HANDSHAKE_BYTES = struct.pack('20s', b'SWKH')
 _HANDSHAKE_SERVER_PORT = 9978
 _TFTP_SERVER_PORT = 69
 _TIME_FMT = '%c'
 _DEFAULT_BLOCK_SIZE = 512
+# RFC 2348 bounds on the negotiated block size.
+_MIN_BLOCK_SIZE = 8
+_MAX_BLOCK_SIZE = 65464
+# Largest RFC 7440 window we'll agree to; also the sendmmsg(2) batch size.
+_MAX_WINDOW_SIZE = 64
+# Kernel socket buffer size requested for both UDP sockets. On Linux this is
+# capped by net.core.rmem_max / net.core.wmem_max; raise them with e.g.
+# "sysctl -w net.core.rmem_max=12582912 net.core.wmem_max=12582912".
+_DEFAULT_SOCKET_BUF_BYTES = 4 * 1024 * 1024
+# Minimum seconds between --verbose progress bar updates (i.e. 20 Hz).
+_PROGRESS_INTERVAL = 0.05
+_PROGRESS_WIDTH = 53
+# Every possible bar is a window of this: k '#'s are [WIDTH - k : 2 * WIDTH - k].
+_PROGRESS_TEMPLATE = '#' * _PROGRESS_WIDTH + ' ' * _PROGRESS_WIDTH
+
+# Precompiled TFTP header formats; the DATA send path uses these once per block.
+_OPCODE_STRUCT = struct.Struct('>h')
+_DATA_HDR_STRUCT = struct.Struct('>hH')
+# ACKs share the DATA header layout (opcode, block), so one unpack reads both.
+_UNPACK_HDR_FROM = _DATA_HDR_STRUCT.unpack_from
+_PACK_DATA_INTO = _DATA_HDR_STRUCT.pack_into
+_HDR_LEN = _DATA_HDR_STRUCT.size
+# Scatter/gather sends aren't available everywhere (notably Windows).
+_HAVE_SENDMSG = hasattr(socket.socket, 'sendmsg')
+# Per-call non-blocking receives; missing on Windows.
+_MSG_DONTWAIT: Optional[int] = getattr(socket, 'MSG_DONTWAIT', None)
+# Only Linux load-balances datagrams across SO_REUSEPORT sockets.
+_HAVE_REUSEPORT = sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.c_void_p),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [
+        ('sin_family', ctypes.c_ushort),
+        ('sin_port', ctypes.c_uint16),
+        ('sin_addr', ctypes.c_uint8 * 4),
+        ('sin_zero', ctypes.c_uint8 * 8),
+    ]
+
+
+def _load_sendmmsg() -> Optional[Callable[..., int]]:
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (AttributeError, OSError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    fn.restype = ctypes.c_int
+    return fn  # type: ignore[no-any-return]
+
+
+_SENDMMSG = _load_sendmmsg()
 
 
 class Error(Exception):
     pass
 
 
+def _make_sender(
+    sock: socket.socket,
+    opcode: int,
+    file_mv: memoryview,
+    block_size: int,
+    send_buf: bytearray,
+) -> Callable[[int, Tuple[str, int]], int]:
+    """Returns a function which sends DATA block N and returns its end offset.
+
+    Everything fixed for the transfer is bound as a closure variable so the
+    per-block path avoids attribute lookups.
+    """
+    file_len = len(file_mv)
+    send_mv = memoryview(send_buf)
+    hdr_mv = send_mv[:_HDR_LEN]
+    pack_into = _PACK_DATA_INTO
+
+    if _HAVE_SENDMSG:
+        sendmsg = sock.sendmsg
+
+        def send_block(block: int, addr: Tuple[str, int]) -> int:
+            start_byte = (block - 1) * block_size
+            end_byte = min(start_byte + block_size, file_len)
+            pack_into(send_buf, 0, opcode, block)
+            # Gather the header and a view of the file; no block copy.
+            sendmsg([hdr_mv, file_mv[start_byte:end_byte]], (), 0, addr)
+            return end_byte
+
+    else:
+        sendto = sock.sendto
+
+        def send_block(block: int, addr: Tuple[str, int]) -> int:
+            start_byte = (block - 1) * block_size
+            end_byte = min(start_byte + block_size, file_len)
+            pkt_len = _HDR_LEN + end_byte - start_byte
+            pack_into(send_buf, 0, opcode, block)
+            send_mv[_HDR_LEN:pkt_len] = file_mv[start_byte:end_byte]
+            sendto(send_mv[:pkt_len], addr)
+            return end_byte
+
+    return send_block
+
+
+class _MMsgPool:
+    """sendmmsg(2) arguments for a window of DATA packets, reused across calls.
+
+    Message i is a two-entry iovec: a 4-byte header in `headers` and a slice
+    of the file filled in per call.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.headers = bytearray(_HDR_LEN * size)
+        self.sockaddr = _SockAddrIn(sin_family=socket.AF_INET)
+        self.iovecs = (_IoVec * (2 * size))()
+        self.msgs = (_MMsgHdr * size)()
+        self._headers_c = (ctypes.c_char * len(self.headers)).from_buffer(self.headers)
+        headers_base = ctypes.addressof(self._headers_c)
+        iovecs_base = ctypes.addressof(self.iovecs)
+        for i in range(size):
+            self.iovecs[2 * i].iov_base = headers_base + i * _HDR_LEN
+            self.iovecs[2 * i].iov_len = _HDR_LEN
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.sockaddr)
+            hdr.msg_namelen = ctypes.sizeof(self.sockaddr)
+            hdr.msg_iov = iovecs_base + 2 * i * ctypes.sizeof(_IoVec)
+            hdr.msg_iovlen = 2
+
+
+def _make_window_sender(
+    sock: socket.socket,
+    opcode: int,
+    file_contents: bytes,
+    block_size: int,
+    send_block: Callable[[int, Tuple[str, int]], int],
+    pool: Optional[_MMsgPool],
+) -> Callable[[int, int, Tuple[str, int]], int]:
+    """Returns a function which sends COUNT blocks starting at FIRST.
+
+    Like the function from _make_sender(), it returns the end offset of the
+    last block sent. With a pool, the whole window goes out in one
+    sendmmsg(2) call; otherwise it falls back to one send per block.
+    """
+    if pool is None:
+
+        def send_window_loop(first: int, count: int, addr: Tuple[str, int]) -> int:
+            end_byte = 0
+            for block in range(first, first + count):
+                end_byte = send_block(block, addr)
+            return end_byte
+
+        return send_window_loop
+
+    assert _SENDMMSG is not None
+    sendmmsg = _SENDMMSG
+    fd = sock.fileno()
+    file_len = len(file_contents)
+    # c_char_p points at the bytes object's own storage; no copy is made.
+    file_base = ctypes.cast(ctypes.c_char_p(file_contents), ctypes.c_void_p).value or 0
+    pack_into = _PACK_DATA_INTO
+    headers = pool.headers
+    sockaddr = pool.sockaddr
+    iovecs = pool.iovecs
+    msgs = pool.msgs
+    mmsghdr_size = ctypes.sizeof(_MMsgHdr)
+
+    def send_window(first: int, count: int, addr: Tuple[str, int]) -> int:
+        # The pool is shared by every window sender, so always set the address.
+        sockaddr.sin_port = socket.htons(addr[1])
+        sockaddr.sin_addr[:] = socket.inet_aton(addr[0])
+        start_byte = (first - 1) * block_size
+        end_byte = start_byte
+        for i in range(count):
+            end_byte = min(start_byte + block_size, file_len)
+            pack_into(headers, i * _HDR_LEN, opcode, first + i)
+            iov = iovecs[2 * i + 1]
+            iov.iov_base = file_base + start_byte
+            iov.iov_len = end_byte - start_byte
+            start_byte += block_size
+        sent = 0
+        while sent < count:
+            n = sendmmsg(fd, ctypes.byref(msgs, sent * mmsghdr_size), count - sent, 0)
+            if n < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            sent += n
+        return end_byte
+
+    return send_window
+
+
+class _Transfer:
+    """State of one client's read request."""
+
+    __slots__ = (
+        'block_size',
+        'window_size',
+        'total_blocks',
+        'milestone_blocks',
+        'sender',
+        'window_sender',
+        'start_time',
+        'bytes_sent',
+        'blocks_sent',
+        'last_bar_time',
+    )
+
+    def __init__(
+        self,
+        block_size: int,
+        window_size: int,
+        file_len: int,
+        sender: Callable[[int, Tuple[str, int]], int],
+        window_sender: Callable[[int, int, Tuple[str, int]], int],
+    ) -> None:
+        self.block_size = block_size
+        self.window_size = window_size
+        # Not a ceiling: a file that's an exact multiple of the block size
+        # still needs a trailing empty DATA block to end the transfer.
+        self.total_blocks = (file_len + block_size) // block_size
+        # Blocks at which to log 25%, 50% and 75% progress. In a short file
+        # several may land on one block; going high to low leaves the lowest,
+        # which is the block's real progress.
+        self.milestone_blocks: Dict[int, int] = {}
+        for percent in (75, 50, 25):
+            block = self.total_blocks * percent // 100
+            if block:
+                self.milestone_blocks[block] = percent
+        self.sender = sender
+        self.window_sender = window_sender
+        self.start_time = time.time()
+        self.bytes_sent = 0
+        self.blocks_sent = 0
+        self.last_bar_time = 0.0
+
+
 class Server:
     # See https://tools.ietf.org/html/rfc1350
     _TFTP_OPCODE_RRQ = 1
     _TFTP_OPCODE_DATA = 3
     _TFTP_OPCODE_ACK = 4
+    _TFTP_OPCODE_ERROR = 5
     _TFTP_OPCODE_OACK = 6
-    _TFTP_ACK_PREFIX = struct.pack('>h', _TFTP_OPCODE_ACK)
+    # Error codes: 0 is "not defined, see error message"; 8 is RFC 2347's
+    # "option negotiation failed".
+    _TFTP_ERROR_UNDEFINED = 0
+    _TFTP_ERROR_OPTION = 8
 
     def __init__(
         self,
@@ -41,23 +298,69 @@ class Server:
         tftp_addr: Tuple[str, int],
         filename: str,
         file_contents: bytes,
+        socket_buf_bytes: int = _DEFAULT_SOCKET_BUF_BYTES,
+        verbose: bool = False,
+        reuse_port: bool = False,
+        max_block_size: int = _MAX_BLOCK_SIZE,
     ) -> None:
         self._file_contents = file_contents
+        self._file_len = len(file_contents)
+        self._file_mv = memoryview(file_contents)
+        # Larger client requests are clamped to this, so the one DATA packet
+        # buffer reused for every block never has to grow.
+        self._max_block_size = max_block_size
+        self._send_buf = bytearray(_HDR_LEN + max(max_block_size, _DEFAULT_BLOCK_SIZE))
         self._filename = filename
         self._tftp_rrq_prefix = (
-            struct.pack('>h', self._TFTP_OPCODE_RRQ)
+            _OPCODE_STRUCT.pack(self._TFTP_OPCODE_RRQ)
             + filename.encode('utf-8')
             + b'\x00'
         )
+        self._tftp_rrq_prefix_len = len(self._tftp_rrq_prefix)
         self._tftp_blksize_option = b'blksize\x00'
+        self._socket_buf_bytes = socket_buf_bytes
+        self._verbose = verbose
+        self._reuse_port = reuse_port
         self._handshake_sock = self._bind(handshake_addr)
         self._tftp_sock = self._bind(tftp_addr)
-        self._set_block_size(_DEFAULT_BLOCK_SIZE)
-        # Track active transfers for logging
-        self._active_transfers: Dict[str, Dict[str, float]] = {}
+        # Receive buffer reused for every TFTP datagram.
+        self._rx_buf = bytearray(65536)
+        self._rx_mv = memoryview(self._rx_buf)
+        self._mmsg_pool = _MMsgPool(_MAX_WINDOW_SIZE) if _SENDMMSG is not None else None
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(
+            self._handshake_sock, selectors.EVENT_READ, self._handshake_read
+        )
+        self._sel.register(self._tftp_sock, selectors.EVENT_READ, self._tftp_read)
+        # Senders specialized per block size, shared by all transfers using it.
+        # Clients pick the block size, so only the default and the maximum
+        # (what most clients end up with) are kept; others are built per RRQ.
+        self._senders: Dict[
+            int,
+            Tuple[
+                Callable[[int, Tuple[str, int]], int],
+                Callable[[int, int, Tuple[str, int]], int],
+            ],
+        ] = {}
+        self._transfers: Dict[Tuple[str, int], _Transfer] = {}
+        # OACK packets keyed by (blksize, windowsize) as sent. Like the sender
+        # cache, only the default and maximum block sizes are kept; windowsize
+        # is clamped to _MAX_WINDOW_SIZE, which bounds the rest of the key.
+        self._oack_cache: Dict[Tuple[Optional[int], Optional[int]], bytes] = {}
+        log.info(
+            'Serving %d-byte %s (default block size %d)',
+            self._file_len,
+            self._filename,
+            _DEFAULT_BLOCK_SIZE,
+        )
 
     def _bind(self, addr: Tuple[str, int]) -> socket.socket:
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self._reuse_port:
+            # Lets several worker processes bind the same port. The kernel
+            # hashes each client's address to one socket, so a transfer's
+            # packets all reach the worker holding its state.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             sock.bind(addr)
         except OSError as e:
@@ -81,37 +384,101 @@ class Server:
                     f'Try running with sudo.'
                 ) from e
             raise
+        for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, self._socket_buf_bytes)
+            except OSError:
+                # Best effort; the kernel default still works, just with less
+                # headroom for bursts.
+                pass
         return sock
 
-    def _set_block_size(self, block_size: int) -> None:
-        # TODO: Don't mutate overall server for a single transfer. Use some kind of per-transfer state
-        print(f'Setting block size to {block_size}')
-        self._block_size = block_size
-        self._total_blocks = (
-            len(self._file_contents) + self._block_size
-        ) // self._block_size
-        print(
-            f'Serving {len(self._file_contents)}-byte {self._filename} (block size {self._block_size}, {self._total_blocks} blocks)'
+    def _new_transfer(self, block_size: int, window_size: int) -> _Transfer:
+        senders = self._senders.get(block_size)
+        if senders is None:
+            sender = _make_sender(
+                self._tftp_sock,
+                self._TFTP_OPCODE_DATA,
+                self._file_mv,
+                block_size,
+                self._send_buf,
+            )
+            window_sender = _make_window_sender(
+                self._tftp_sock,
+                self._TFTP_OPCODE_DATA,
+                self._file_contents,
+                block_size,
+                sender,
+                self._mmsg_pool,
+            )
+            senders = (sender, window_sender)
+            if block_size in (_DEFAULT_BLOCK_SIZE, self._max_block_size):
+                self._senders[block_size] = senders
+        transfer = _Transfer(block_size, window_size, self._file_len, *senders)
+        if transfer.total_blocks > 65535:
+            raise Error(f'File is too big to serve with {block_size}-byte blocks.')
+        return transfer
+
+    def _parse_options(self, pkt: memoryview) -> Dict[str, str]:
+        # The caller has already matched the RRQ prefix; what's left is the
+        # mode followed by option name/value pairs, all NUL-terminated.
+        # Undecodable bytes are replaced so that a garbled option is ignored
+        # or rejected by _negotiate_option like any other bad value.
+        fields = bytes(pkt[self._tftp_rrq_prefix_len :]).split(b'\x00')
+        options = dict(
+            zip(
+                (name.decode('utf-8', errors='replace') for name in fields[1::2]),
+                (value.decode('utf-8', errors='replace') for value in fields[2::2]),
+            )
         )
+        log.info('read request options: %s', options)
+        return options
 
-    def _check_total_block_limit(self) -> None:
-        if self._total_blocks > 65535:
-            raise Error(
-                f'File is too big to serve with {self._block_size}-byte blocks.'
+    def _negotiate_option(
+        self,
+        options: Dict[str, str],
+        name: str,
+        low: int,
+        high: int,
+        addr: Tuple[str, int],
+    ) -> Optional[int]:
+        """Returns the value to use for a numeric option, or None if not sent.
+
+        RFCs 2348 and 7440 let the server answer with a smaller value, so big
+        requests are clamped to HIGH. Malformed or too-small values are removed
+        from OPTIONS so they aren't acknowledged.
+        """
+        value = options.get(name)
+        if value is None:
+            return None
+        try:
+            requested = int(value)
+        except ValueError:
+            requested = low - 1
+        if requested < low:
+            log.warning(
+                '%s:%d - TFTP_RRQ - "%s %s" 400 - ignoring invalid option',
+                addr[0],
+                addr[1],
+                name,
+                value,
             )
-
-    def _parse_options(self, pkt: bytes) -> Dict[str, str]:
-        pkt_options = pkt.split(self._tftp_rrq_prefix)[1]
-        options_list = pkt_options.split(b'\x00')[1:]
-        options = {}
-        for i in range(0, len(options_list) - 1, 2):
-            options[options_list[i].decode('utf-8')] = options_list[i + 1].decode(
-                'utf-8'
+            del options[name]
+            return None
+        if requested > high:
+            log.info(
+                '%s:%d - TFTP_OACK - "%s %d" - clamped to %d',
+                addr[0],
+                addr[1],
+                name,
+                requested,
+                high,
             )
-        print(f'read request options: {options}')
-        return options
+            return high
+        return requested
 
     def close(self) -> None:
+        self._sel.close()
         self._handshake_sock.close()
         self._tftp_sock.close()
 
@@ -120,136 +487,254 @@ class Server:
             self._iterate()
 
     def _iterate(self) -> None:
-        r, _, _ = select.select([self._handshake_sock, self._tftp_sock], [], [])
-        if self._handshake_sock in r:
-            self._handshake_read()
-        if self._tftp_sock in r:
-            self._tftp_read()
+        for key, _ in self._sel.select():
+            key.data()
 
     def _handshake_read(self) -> None:
         pkt, addr = self._handshake_sock.recvfrom(len(HANDSHAKE_BYTES))
-        now = time.strftime(_TIME_FMT)
         if pkt == HANDSHAKE_BYTES:
             try:
                 self._handshake_sock.sendto(pkt, addr)
-                print(
-                    f'{now}: {addr[0]}:{addr[1]} - HANDSHAKE - "SWKH" 200 {len(HANDSHAKE_BYTES)}'
+                log.info(
+                    '%s:%d - HANDSHAKE - "SWKH" 200 %d',
+                    addr[0],
+                    addr[1],
+                    len(HANDSHAKE_BYTES),
                 )
             except OSError as e:
-                print(
-                    f'{now}: {addr[0]}:{addr[1]} - HANDSHAKE - "SWKH" 503 {len(HANDSHAKE_BYTES)} - network error: {e}'
+                log.warning(
+                    '%s:%d - HANDSHAKE - "SWKH" 503 %d - network error: %s',
+                    addr[0],
+                    addr[1],
+                    len(HANDSHAKE_BYTES),
+                    e,
                 )
         else:
-            print(
-                f'{now}: {addr[0]}:{addr[1]} - HANDSHAKE - "INVALID" 400 {len(pkt)} - unexpected handshake bytes {pkt.hex()!r}'
+            log.warning(
+                '%s:%d - HANDSHAKE - "INVALID" 400 %d - unexpected handshake bytes %r',
+                addr[0],
+                addr[1],
+                len(pkt),
+                pkt.hex(),
             )
 
     def _tftp_read(self) -> None:
-        pkt, addr = self._tftp_sock.recvfrom(65536)
-        now = time.strftime(_TIME_FMT)
-        client_key = f'{addr[0]}:{addr[1]}'
-
-        if pkt.startswith(self._tftp_rrq_prefix):
+        # The selector says one datagram is ready; drain anything else queued
+        # behind it without blocking. The socket itself stays blocking so DATA
+        # sends wait for buffer space rather than failing with EAGAIN.
+        flags = 0
+        while True:
+            try:
+                n, addr = self._tftp_sock.recvfrom_into(self._rx_buf, 0, flags)
+            except BlockingIOError:
+                return
+            self._tftp_process(self._rx_mv[:n], addr)
+            if _MSG_DONTWAIT is None:
+                return
+            flags = _MSG_DONTWAIT
+
+    def _tftp_process(self, pkt: memoryview, addr: Tuple[str, int]) -> None:
+        pkt_len = len(pkt)
+        # No valid packet is shorter than an ACK.
+        opcode, block = _UNPACK_HDR_FROM(pkt) if pkt_len >= _HDR_LEN else (0, 0)
+
+        # ACKs are by far the most common packet, so check for them first.
+        if opcode == self._TFTP_OPCODE_ACK:
+            transfer = self._transfers.get(addr)
+            if transfer is None:
+                log.warning(
+                    '%s:%d - TFTP_ACK - "block %d" 404 - no active transfer',
+                    addr[0],
+                    addr[1],
+                    block,
+                )
+                return
+            self._tftp_maybe_send(transfer, block, addr)
+        elif (
+            opcode == self._TFTP_OPCODE_RRQ
+            and pkt[: self._tftp_rrq_prefix_len] == self._tftp_rrq_prefix
+        ):
             # Log the read request
-            print(
-                f'{now}: {addr[0]}:{addr[1]} - TFTP_RRQ - "GET {self._filename}" - {len(self._file_contents)} bytes'
+            log.info(
+                '%s:%d - TFTP_RRQ - "GET %s" - %d bytes',
+                addr[0],
+                addr[1],
+                self._filename,
+                self._file_len,
             )
 
-            # Track transfer start time
-            self._active_transfers[client_key] = {
-                'start_time': time.time(),
-                'bytes_sent': 0,
-                'blocks_sent': 0,
-            }
-
             options = self._parse_options(pkt)
-            if 'blksize' in options:
-                self._set_block_size(int(options['blksize']))
-                print(
-                    f'{now}: {addr[0]}:{addr[1]} - TFTP_OACK - "blksize {self._block_size}" - negotiated block size'
+            block_size = self._negotiate_option(
+                options, 'blksize', _MIN_BLOCK_SIZE, self._max_block_size, addr
+            )
+            if block_size is None:
+                block_size = _DEFAULT_BLOCK_SIZE
+            else:
+                log.info(
+                    '%s:%d - TFTP_OACK - "blksize %d" - negotiated block size',
+                    addr[0],
+                    addr[1],
+                    block_size,
+                )
+            window_size = self._negotiate_option(
+                options, 'windowsize', 1, _MAX_WINDOW_SIZE, addr
+            )
+            if window_size is None:
+                window_size = 1
+            else:
+                log.info(
+                    '%s:%d - TFTP_OACK - "windowsize %d" - negotiated window size',
+                    addr[0],
+                    addr[1],
+                    window_size,
                 )
-                self._tftp_options_ack(addr)
+
+            # A new RRQ from the same address replaces any unfinished transfer.
+            self._transfers.pop(addr, None)
+            try:
+                transfer = self._new_transfer(block_size, window_size)
+            except Error as e:
+                # RFC 2348 doesn't let the OACK raise the client's blksize, so
+                # one too small to reach the end of the file can't be fixed up.
+                log.warning(
+                    '%s:%d - TFTP_ERROR - "blksize %d" 413 - %s',
+                    addr[0],
+                    addr[1],
+                    block_size,
+                    e,
+                )
+                code = (
+                    self._TFTP_ERROR_OPTION
+                    if 'blksize' in options
+                    else self._TFTP_ERROR_UNDEFINED
+                )
+                self._tftp_error(addr, code, str(e))
+                return
+            self._transfers[addr] = transfer
+            if 'blksize' in options or 'windowsize' in options:
+                self._tftp_options_ack(transfer, addr, options)
                 return
-            self._check_total_block_limit()
-            self._tftp_maybe_send(0, addr)
-        elif pkt.startswith(self._TFTP_ACK_PREFIX):
-            (block,) = struct.unpack('>H', pkt[len(self._TFTP_ACK_PREFIX) :])
-            self._tftp_maybe_send(block, addr)
+            self._tftp_maybe_send(transfer, 0, addr)
         else:
-            print(
-                f'{now}: {addr[0]}:{addr[1]} - TFTP_ERROR - "INVALID" 400 {len(pkt)} - unexpected tftp bytes {pkt.hex()!r}'
+            log.warning(
+                '%s:%d - TFTP_ERROR - "INVALID" 400 %d - unexpected tftp bytes %r',
+                addr[0],
+                addr[1],
+                pkt_len,
+                pkt.hex(),
             )
 
-    def _tftp_options_ack(self, addr: Tuple[str, int]) -> None:
-        self._check_total_block_limit()
+    def _tftp_error(self, addr: Tuple[str, int], code: int, message: str) -> None:
         pkt = (
-            struct.pack('>H', self._TFTP_OPCODE_OACK)
-            + b'blksize\x00'
-            + str(self._block_size).encode('utf-8')
+            _DATA_HDR_STRUCT.pack(self._TFTP_OPCODE_ERROR, code)
+            + message.encode('utf-8')
             + b'\x00'
         )
         try:
             self._tftp_sock.sendto(pkt, addr)
         except OSError as e:
-            now = time.strftime(_TIME_FMT)
-            print(
-                f'{now}: {addr[0]}:{addr[1]} - TFTP_OACK - "blksize {self._block_size}" 503 - network error: {e}'
+            log.warning('%s:%d - TFTP_ERROR - network error: %s', addr[0], addr[1], e)
+
+    def _tftp_options_ack(
+        self, transfer: _Transfer, addr: Tuple[str, int], options: Dict[str, str]
+    ) -> None:
+        # None marks an option the client didn't ask for, and so isn't echoed.
+        key = (
+            transfer.block_size if 'blksize' in options else None,
+            transfer.window_size if 'windowsize' in options else None,
+        )
+        pkt = self._oack_cache.get(key)
+        if pkt is None:
+            pkt = _OPCODE_STRUCT.pack(self._TFTP_OPCODE_OACK)
+            if key[0] is not None:
+                pkt += b'blksize\x00' + str(key[0]).encode('utf-8') + b'\x00'
+            if key[1] is not None:
+                pkt += b'windowsize\x00' + str(key[1]).encode('utf-8') + b'\x00'
+            if key[0] in (None, _DEFAULT_BLOCK_SIZE, self._max_block_size):
+                self._oack_cache[key] = pkt
+        try:
+            self._tftp_sock.sendto(pkt, addr)
+        except OSError as e:
+            log.warning(
+                '%s:%d - TFTP_OACK - "blksize %d windowsize %d" 503 - network error: %s',
+                addr[0],
+                addr[1],
+                transfer.block_size,
+                transfer.window_size,
+                e,
             )
 
-    def _tftp_maybe_send(self, prev_block: int, addr: Tuple[str, int]) -> None:
+    def _tftp_maybe_send(
+        self, transfer: _Transfer, prev_block: int, addr: Tuple[str, int]
+    ) -> None:
         block = prev_block + 1
-        start_byte = prev_block * self._block_size
-        client_key = f'{addr[0]}:{addr[1]}'
-        now = time.strftime(_TIME_FMT)
-
-        if start_byte > len(self._file_contents):
+        if block > transfer.total_blocks:
             # Transfer completed - log completion stats
-            if client_key in self._active_transfers:
-                transfer_info = self._active_transfers[client_key]
-                duration = time.time() - transfer_info['start_time']
-                print(
-                    f'{now}: {addr[0]}:{addr[1]} - TFTP_COMPLETE - "GET {self._filename}" 200 {len(self._file_contents)} - {duration:.2f}s - {transfer_info["blocks_sent"]} blocks'
-                )
-                del self._active_transfers[client_key]
-            else:
-                print(
-                    f'{now}: {addr[0]}:{addr[1]} - TFTP_COMPLETE - "GET {self._filename}" 200 {len(self._file_contents)} - transfer complete'
-                )
-
-            if self._block_size != _DEFAULT_BLOCK_SIZE:
-                self._set_block_size(_DEFAULT_BLOCK_SIZE)
+            log.info(
+                '%s:%d - TFTP_COMPLETE - "GET %s" 200 %d - %.2fs - %d blocks',
+                addr[0],
+                addr[1],
+                self._filename,
+                self._file_len,
+                time.time() - transfer.start_time,
+                transfer.blocks_sent,
+            )
+            del self._transfers[addr]
             return
 
-        block_data = self._file_contents[start_byte : start_byte + self._block_size]
-        pkt = struct.pack('>hH', self._TFTP_OPCODE_DATA, block) + block_data
+        # With an RFC 7440 window, an ACK releases the next window of blocks.
+        count = min(transfer.window_size, transfer.total_blocks - prev_block)
         try:
-            self._tftp_sock.sendto(pkt, addr)
+            if count > 1:
+                end_byte = transfer.window_sender(block, count, addr)
+                block += count - 1
+            else:
+                end_byte = transfer.sender(block, addr)
         except OSError as e:
-            print(
-                f'{now}: {addr[0]}:{addr[1]} - TFTP_DATA - "block {block}" 503 - network error: {e}'
+            log.warning(
+                '%s:%d - TFTP_DATA - "block %d" 503 - network error: %s',
+                addr[0],
+                addr[1],
+                block,
+                e,
             )
             return
 
         # Update transfer tracking
-        if client_key in self._active_transfers:
-            self._active_transfers[client_key]['bytes_sent'] = start_byte + len(
-                block_data
-            )
-            self._active_transfers[client_key]['blocks_sent'] = block
-
-        # Log progress at 25%, 50%, 75% milestones
-        progress_percent = (block * 100) // self._total_blocks
-        if progress_percent in [25, 50, 75] and client_key in self._active_transfers:
-            transfer_info = self._active_transfers[client_key]
-            duration = time.time() - transfer_info['start_time']
-            print(
-                f'{now}: {addr[0]}:{addr[1]} - TFTP_PROGRESS - "{progress_percent}%" - {transfer_info["bytes_sent"]} bytes - {duration:.1f}s'
-            )
+        transfer.bytes_sent = end_byte
+        transfer.blocks_sent = block
+
+        # Log progress at 25%, 50%, 75% milestones; a window may pass several.
+        milestone_blocks = transfer.milestone_blocks
+        for b in range(block - count + 1, block + 1):
+            progress_percent = milestone_blocks.get(b)
+            if progress_percent is not None:
+                log.info(
+                    '%s:%d - TFTP_PROGRESS - "%d%%" - %d bytes - %.1fs',
+                    addr[0],
+                    addr[1],
+                    progress_percent,
+                    transfer.bytes_sent,
+                    time.time() - transfer.start_time,
+                )
+
+        if not self._verbose:
+            return
 
-        # Show block progress bar
-        _progress_width = 53
-        print(
-            f'{now}: {block:5d} / {self._total_blocks:5d} [{"#" * (_progress_width * block // self._total_blocks):<{_progress_width}}]'
+        # Show block progress bar, rate-limited except for the final block.
+        t = time.monotonic()
+        if (
+            t - transfer.last_bar_time < _PROGRESS_INTERVAL
+            and block != transfer.total_blocks
+        ):
+            return
+        transfer.last_bar_time = t
+        filled = _PROGRESS_WIDTH * block // transfer.total_blocks
+        log.info(
+            '%5d / %5d [%s]',
+            block,
+            transfer.total_blocks,
+            _PROGRESS_TEMPLATE[_PROGRESS_WIDTH - filled : 2 * _PROGRESS_WIDTH - filled],
         )
 
 
@@ -264,34 +749,119 @@ def main() -> None:
     parser.add_argument(
         '--server-ip', default='192.0.0.128', help='IP address to serve from.'
     )
+    parser.add_argument(
+        '--socket-buf-bytes',
+        type=int,
+        default=_DEFAULT_SOCKET_BUF_BYTES,
+        help='kernel send/receive buffer size to request for each socket.',
+    )
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='show a progress bar during transfers.',
+    )
+    parser.add_argument(
+        '--blksize-max',
+        type=int,
+        default=_MAX_BLOCK_SIZE,
+        help='largest block size to agree to; bigger client requests are '
+        'clamped to this.',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of server processes sharing the ports via SO_REUSEPORT, '
+        'for recovering many devices at once (Linux only).',
+    )
     args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s: %(message)s',
+        datefmt=_TIME_FMT,
+    )
+    if not _DEFAULT_BLOCK_SIZE <= args.blksize_max <= _MAX_BLOCK_SIZE:
+        parser.error(
+            f'--blksize-max must be between {_DEFAULT_BLOCK_SIZE} and {_MAX_BLOCK_SIZE}'
+        )
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.workers > 1 and not _HAVE_REUSEPORT:
+        parser.error('--workers needs SO_REUSEPORT load balancing (Linux only)')
     try:
         with open(args.filename, mode='rb') as f:
             file_contents = f.read()
     except OSError as e:
-        print(f"Error: can't read {args.filename}")
+        log.error("Error: can't read %s", args.filename)
         if e.errno == errno.ENOENT:
-            print('Please download/move it to the current working directory.')
+            log.error('Please download/move it to the current working directory.')
             sys.exit(1)
         raise
 
+    if args.workers > 1:
+        # Let `kill` shut every worker down the same way Ctrl-C does.
+        signal.signal(signal.SIGTERM, _interrupt)
+    children = []
+    for _ in range(args.workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = _serve(args, file_contents)
+            finally:
+                os._exit(status)
+        children.append(pid)
+    try:
+        status = _serve(args, file_contents)
+    finally:
+        # However this worker stopped, don't leave the others holding the ports.
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    for pid in children:
+        _, child_status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(child_status):
+            log.error('Worker %d killed by signal %d', pid, os.WTERMSIG(child_status))
+            status = 1
+        elif os.WEXITSTATUS(child_status) != 0:
+            log.error(
+                'Worker %d exited with status %d', pid, os.WEXITSTATUS(child_status)
+            )
+            status = 1
+    sys.exit(status)
+
+
+def _interrupt(signum: int, frame: object) -> None:
+    raise KeyboardInterrupt
+
+
+def _serve(args: argparse.Namespace, file_contents: bytes) -> int:
     try:
         server = Server(
             (args.server_ip, _HANDSHAKE_SERVER_PORT),
             (args.server_ip, _TFTP_SERVER_PORT),
             args.filename,
             file_contents,
+            socket_buf_bytes=args.socket_buf_bytes,
+            verbose=args.verbose,
+            reuse_port=args.workers > 1,
+            max_block_size=args.blksize_max,
         )
     except Error as e:
-        print(f'Error: {e}')
-        sys.exit(1)
+        log.error('Error: %s', e)
+        return 1
 
     try:
         server.run_forever()
     except KeyboardInterrupt:
-        print('\nShutting down server...')
+        log.info('Shutting down server...')
     finally:
         server.close()
+    return 0
 
 
 if __name__ == '__main__':
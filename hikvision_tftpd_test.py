@@ -41,9 +41,9 @@ class TftpdTest(unittest.TestCase):
             self._handshake_client.close()
             self._tftp_client.close()
 
-    def _setup(self, data):
+    def _setup(self, data, **kwargs):
         self._server = hikvision_tftpd.Server(
-            ('127.0.0.1', 0), ('127.0.0.1', 0), 'digicap.dav', data
+            ('127.0.0.1', 0), ('127.0.0.1', 0), 'digicap.dav', data, **kwargs
         )
         self._handshake_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._handshake_client.connect(self._server._handshake_sock.getsockname())
@@ -65,13 +65,13 @@ class TftpdTest(unittest.TestCase):
             self.fail(f'expected nothing, got: {d!r}')
 
     def test_eaddrinuse(self):
-        self._setup('')
+        self._setup(b'')
         try:
             hikvision_tftpd.Server(
                 self._server._handshake_sock.getsockname(),
                 self._server._tftp_sock.getsockname(),
                 'digicap.dav',
-                '',
+                b'',
             )
         except hikvision_tftpd.Error as e:
             self.assertTrue('in use' in str(e), f'Unexpected: {e!r}')
@@ -85,7 +85,7 @@ class TftpdTest(unittest.TestCase):
             # (Okay, according to the RFCs, it shouldn't be using 192.0.0.128
             # either, but we do what we must.)
             hikvision_tftpd.Server(
-                ('192.0.2.1', 0), ('192.0.2.1', 0), 'digicap.dav', ''
+                ('192.0.2.1', 0), ('192.0.2.1', 0), 'digicap.dav', b''
             )
         except hikvision_tftpd.Error as e:
             self.assertTrue('not available' in str(e), f'Unexpected: {e!r}')
@@ -99,26 +99,49 @@ class TftpdTest(unittest.TestCase):
     def test_eaccess(self):
         try:
             hikvision_tftpd.Server(
-                ('127.0.0.1', 1), ('127.0.0.1', 3), 'digicap.dav', ''
+                ('127.0.0.1', 1), ('127.0.0.1', 3), 'digicap.dav', b''
             )
         except hikvision_tftpd.Error as e:
             self.assertTrue('permission' in str(e), f'Unexpected: {e!r}')
         else:
             self.fail("expected an error. (did you run the tests as root? don't.)")
 
+    @unittest.skipUnless(
+        hikvision_tftpd._HAVE_REUSEPORT, 'SO_REUSEPORT load balancing is Linux-only'
+    )
+    def test_reuse_port(self):
+        first = hikvision_tftpd.Server(
+            ('127.0.0.1', 0), ('127.0.0.1', 0), 'digicap.dav', b'', reuse_port=True
+        )
+        self.addCleanup(first.close)
+        second = hikvision_tftpd.Server(
+            first._handshake_sock.getsockname(),
+            first._tftp_sock.getsockname(),
+            'digicap.dav',
+            b'',
+            reuse_port=True,
+        )
+        second.close()
+
     def test_proper_handshake(self):
-        self._setup('')
+        self._setup(b'')
         self._handshake_client.send(hikvision_tftpd.HANDSHAKE_BYTES)
         self._server._iterate()
         pkt = self._handshake_client.recv(self._LARGE_BUFFER_SIZE)
         self.assertEqual(hikvision_tftpd.HANDSHAKE_BYTES, pkt)
 
     def test_bogus_handshake(self):
-        self._setup('')
+        self._setup(b'')
         self._handshake_client.send(b'asdf')
         self._server._iterate()
         self._assert_no_data()
 
+    def test_truncated_ack(self):
+        self._setup(b'x' * 10)
+        self._tftp_client.send(b'\x00\x04\x00')
+        self._server._iterate()
+        self._assert_no_data()
+
     def test_one_block(self):
         data = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
         self._setup(data)
@@ -212,6 +235,194 @@ class TftpdTest(unittest.TestCase):
         self._server._iterate()
         self._assert_no_data()
 
+    def test_drains_queued_packets(self):
+        data = b'x' * 10
+        self._setup(data)
+        self._tftp_client.send(b'bogus')
+        self._tftp_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE)
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x03\x00\x01' + data, pkt)
+
+        # Draining mustn't leave the socket non-blocking for DATA sends.
+        self.assertTrue(self._server._tftp_sock.getblocking())
+
+    def test_windowsize(self):
+        blocksize = 512
+        data = bytes(range(256)) * 5
+        self._setup(data)
+        self._tftp_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE + b'windowsize\x004\x00')
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x06windowsize\x004\x00', pkt)
+
+        # OACK ACK releases the whole (3-block) file at once.
+        self._tftp_client.send(b'\x00\x04\x00\x00')
+        self._server._iterate()
+        for block in range(1, 4):
+            pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+            self.assertEqual(
+                b'\x00\x03\x00'
+                + bytes([block])
+                + data[(block - 1) * blocksize : block * blocksize],
+                pkt,
+            )
+
+        # No more packets.
+        self._tftp_client.send(b'\x00\x04\x00\x03')
+        self._server._iterate()
+        self._assert_no_data()
+
+    def test_window_progress_milestones(self):
+        # Five blocks: the 25%, 50% and 75% milestones all fall in the first
+        # 3-block window, and each should still be logged.
+        self._setup(b'x' * (512 * 4 + 100))
+        self._tftp_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE + b'windowsize\x003\x00')
+        self._server._iterate()
+        self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+
+        with self.assertLogs('hikvision_tftpd') as logs:
+            self._tftp_client.send(b'\x00\x04\x00\x00')
+            self._server._iterate()
+        progress = [line for line in logs.output if 'TFTP_PROGRESS' in line]
+        self.assertEqual(3, len(progress))
+        for line, percent in zip(progress, ('25%', '50%', '75%')):
+            self.assertIn(percent, line)
+
+    def test_short_file_progress_milestones(self):
+        # Two blocks: block 1 is 50% of the way, not 75%, and nothing is
+        # logged for a block 0.
+        self._setup(b'x' * 600)
+        with self.assertLogs('hikvision_tftpd') as logs:
+            self._tftp_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE)
+            self._server._iterate()
+        progress = [line for line in logs.output if 'TFTP_PROGRESS' in line]
+        self.assertEqual(1, len(progress))
+        self.assertIn('"50%"', progress[0])
+
+    def test_concurrent_transfers(self):
+        data = b'x' * 1000
+        self._setup(data)
+        other_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(other_client.close)
+        other_client.connect(self._server._tftp_sock.getsockname())
+        other_client.settimeout(0.1)
+
+        # One client negotiates a block size, the other uses the default.
+        self._tftp_client.send(self._TEST_RRQ)
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x06' + self._BLKSIZE_OPTION, pkt)
+        other_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE)
+        self._server._iterate()
+        pkt = other_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x03\x00\x01' + data[:512], pkt)
+
+        # The first client's transfer still uses its own block size.
+        self._tftp_client.send(b'\x00\x04\x00\x00')
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x03\x00\x01' + data, pkt)
+        other_client.send(b'\x00\x04\x00\x01')
+        self._server._iterate()
+        pkt = other_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x03\x00\x02' + data[512:], pkt)
+
+    def test_blksize_clamped(self):
+        data = b'x' * 2000
+        self._setup(data, max_block_size=1024)
+        self._tftp_client.send(self._TEST_RRQ)
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x06blksize\x001024\x00', pkt)
+
+        # OACK ACK
+        self._tftp_client.send(b'\x00\x04\x00\x00')
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x03\x00\x01' + data[:1024], pkt)
+
+    def test_caches_bounded(self):
+        data = b'x' * 10
+        self._setup(data, max_block_size=1024)
+        for blksize in range(100, 110):
+            self._tftp_client.send(
+                self._TEST_RRQ_DEFAULT_BLKSIZE
+                + b'blksize\x00'
+                + str(blksize).encode()
+                + b'\x00'
+            )
+            self._server._iterate()
+            self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual({}, self._server._senders)
+        self.assertEqual({}, self._server._oack_cache)
+
+        self._tftp_client.send(self._TEST_RRQ)
+        self._server._iterate()
+        self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual([1024], list(self._server._senders))
+        self.assertEqual([(1024, None)], list(self._server._oack_cache))
+
+    def test_blksize_invalid(self):
+        data = b'x' * 10
+        self._setup(data)
+        for blksize in (b'1', b'bogus'):
+            self._tftp_client.send(
+                self._TEST_RRQ_DEFAULT_BLKSIZE + b'blksize\x00' + blksize + b'\x00'
+            )
+            self._server._iterate()
+
+            # The option is ignored rather than acknowledged.
+            pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+            self.assertEqual(b'\x00\x03\x00\x01' + data, pkt)
+
+    def test_options_not_utf8(self):
+        data = b'x' * 10
+        self._setup(data)
+        for option in (b'\xff\x00\x01\x00', b'blksize\x00\xff\x00'):
+            self._tftp_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE + option)
+            self._server._iterate()
+
+            pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+            self.assertEqual(b'\x00\x03\x00\x01' + data, pkt)
+
+    def test_concurrent_windowed_transfers(self):
+        data = bytes(range(256)) * 40
+        self._setup(data)
+        other_client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(other_client.close)
+        other_client.connect(self._server._tftp_sock.getsockname())
+        other_client.settimeout(0.1)
+        clients = [(self._tftp_client, 512), (other_client, 1024)]
+
+        for client, blocksize in clients:
+            option = str(blocksize).encode('ascii')
+            client.send(
+                self._TEST_RRQ_DEFAULT_BLKSIZE
+                + b'blksize\x00'
+                + option
+                + b'\x00windowsize\x004\x00'
+            )
+            self._server._iterate()
+            pkt = client.recv(self._LARGE_BUFFER_SIZE)
+            self.assertEqual(
+                b'\x00\x06blksize\x00' + option + b'\x00windowsize\x004\x00', pkt
+            )
+
+        # Alternate windows between the clients; each must get its own blocks.
+        for first in (1, 5):
+            for client, blocksize in clients:
+                client.send(b'\x00\x04\x00' + bytes([first - 1]))
+                self._server._iterate()
+                for block in range(first, first + 4):
+                    pkt = client.recv(self._LARGE_BUFFER_SIZE)
+                    self.assertEqual(
+                        b'\x00\x03\x00'
+                        + bytes([block])
+                        + data[(block - 1) * blocksize : block * blocksize],
+                        pkt,
+                    )
+
     def test_max_file_size(self):
         # The number of blocks in the file must fit within 16 bits.
         # The final block can't be full.
@@ -224,9 +435,27 @@ class TftpdTest(unittest.TestCase):
         self._server._iterate()
         self._server.close()
 
-        self._setup(b'x' * (max_size + 1))
+        # Too big even at the largest block size the server will use: the
+        # client gets an ERROR and the server keeps running.
+        self._setup(b'x' * (max_size + 1), max_block_size=self._BLOCK_SIZE)
         self._tftp_client.send(self._TEST_RRQ)
-        self.assertRaises(hikvision_tftpd.Error, self._server._iterate)
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x05\x00\x08', pkt[:4])
+        self.assertEqual(b'\x00', pkt[-1:])
+        self.assertNotIn(self._tftp_client.getsockname(), self._server._transfers)
+
+    def test_blksize_too_small(self):
+        # 8-byte blocks would need more than 65535 of them, and the OACK may
+        # not offer a bigger size than the client asked for.
+        data = b'x' * (65535 * 8)
+        self._setup(data)
+        self._tftp_client.send(self._TEST_RRQ_DEFAULT_BLKSIZE + b'blksize\x008\x00')
+        self._server._iterate()
+        pkt = self._tftp_client.recv(self._LARGE_BUFFER_SIZE)
+        self.assertEqual(b'\x00\x05\x00\x08', pkt[:4])
+        self.assertEqual(b'\x00', pkt[-1:])
+        self.assertNotIn(self._tftp_client.getsockname(), self._server._transfers)
 
 
 if __name__ == '__main__':